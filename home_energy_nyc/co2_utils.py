@@ -3,37 +3,74 @@ import pandas as pd
 from nyisotoolkit import NYISOData
 import pickle
 import logging
+import functools
+import zlib
 from os import path
 
 _logger = logging.getLogger(__name__)
 
-CURVES_FILEPATH = path.join(path.dirname(__file__), 'database/co2_curves{year}.pickle')
+CURVES_FILEPATH = path.join(path.dirname(__file__), 'database/co2_curves{year}.npz')
+LEGACY_CURVES_FILEPATH = path.join(path.dirname(__file__), 'database/co2_curves{year}.pickle')
 DEFAULT_YEAR = 2019
 
 
-def calc_grid_co2_avg(dataframe: pd.DataFrame, year=DEFAULT_YEAR):
+@functools.lru_cache(maxsize=8)
+def _load_curves(year):
+    """
+    :param year: The basis year of the curve package.
+    :return: A dict with fuel type as key and a tuple of (cumulative capacity, CO2 rate) float64 arrays.
+    """
+    if not path.exists(CURVES_FILEPATH.format(year=year)) and path.exists(LEGACY_CURVES_FILEPATH.format(year=year)):
+        co2_curves = _load_legacy_curves(year)
+    else:
+        with np.load(CURVES_FILEPATH.format(year=year)) as data:
+            fuels = {k.rsplit('__', 1)[0] for k in data.files}
+            co2_curves = {k: (data[k + '__cap'], data[k + '__rate']) for k in fuels}
+    # Curves are sorted by cumulative capacity once here, as np.interp requires increasing x-coordinates.
+    for k, (cum_cap, co2_rate) in co2_curves.items():
+        order = np.argsort(cum_cap, kind='stable')
+        co2_curves[k] = (cum_cap[order], co2_rate[order])
+    return co2_curves
+
+
+def _load_legacy_curves(year):
+    """Reads a curve package written as a pickle file by earlier versions of generate_curves."""
+    with open(LEGACY_CURVES_FILEPATH.format(year=year), 'rb') as infile:
+        co2_curves = pickle.load(infile)
+    curves = dict()
+    for k, v in co2_curves.items():
+        if isinstance(v, pd.DataFrame):  # Columns are cumulative capacity then CO2 rate, under varying names
+            v = (v.iloc[:, 0], v.iloc[:, 1])
+        curves[k] = tuple(np.asarray(a, dtype=np.float64) for a in v)
+    return curves
+
+
+def calc_grid_co2_avg(dataframe: pd.DataFrame, year=DEFAULT_YEAR, return_total=False):
     """
     :param dataframe: A DataFrame containing fuel mix data.
     :param year: The basis year. There must be a corresponding curve package - see README / Generating CO2 curves.
+    :param return_total: If True, return a tuple of (CO2 intensity, total generation) arrays instead of a DataFrame.
     :return: A DataFrame with CO2 intensity in kg/MWh.
     """
-    df = dataframe.copy().rename_axis('', axis='columns')
-    with open(CURVES_FILEPATH.format(year=year), 'rb') as infile:
-        data = infile.read()
-    if not data:
-        _logger.error('CO2 curves package {file} not found'.format(file=CURVES_FILEPATH))
-    else:
-        co2_curves = pickle.loads(data)
-        df['total_mwh'] = 0.0
-        df['co2_rate'] = 0.0
-        for c in df.columns:
-            if c != 'co2_rate' and c != 'total_mwh':
-                df['total_mwh'] += df[c].apply(lambda x: x / 12)
-                df['co2_rate'] += df[c].apply(lambda x: x / 12 * np.interp(x,
-                                                                           co2_curves[c]['cum_cap'],
-                                                                           co2_curves[c]['co2_rate']))
-        df['co2_rate'] = df['co2_rate'] / df['total_mwh']
-        return df[['co2_rate']]
+    try:
+        co2_curves = _load_curves(year)
+    except FileNotFoundError:
+        _logger.error('CO2 curves package {file} not found'.format(file=CURVES_FILEPATH.format(year=year)))
+        raise
+    cols = [c for c in dataframe.columns if c != 'co2_rate' and c != 'total_mwh']
+    mat = dataframe[cols].to_numpy(dtype=np.float64, copy=False)
+    # The 5-minute to hourly conversion (x / 12) cancels in the weighted average so is omitted.
+    total = mat.sum(axis=1)
+    rate = np.zeros(len(dataframe))
+    for i, c in enumerate(cols):
+        x = mat[:, i]
+        cum_cap, co2_rate = co2_curves[c]
+        rate += x * np.interp(x, cum_cap, co2_rate)
+    with np.errstate(divide='ignore', invalid='ignore'):  # Zero generation intervals give NaN, as pandas would
+        rate /= total
+    if return_total:
+        return rate, total
+    return pd.DataFrame({'co2_rate': rate}, index=dataframe.index)
 
 
 def generate_curves(year: int, egrid_file: str):
@@ -74,54 +111,94 @@ def generate_curves(year: int, egrid_file: str):
 
     # Create a dictionary with fuel type as key and the max. MW generation for that fuel in the year
     # This will be used later to normalize cumulative capacity
-    nyiso_fmix_max = {}
-    for v in fmix_hist_df.columns.values:
-        nyiso_fmix_max[v] = fmix_hist_df[v].max()
-
-    # Open EPA eGRID metric data file, import desired columns from the plant data tab, filter to NYISO only, set Plant
-    # Code as index and map NYISO fuel categories to the EPA fuel code.
-    egrid_plnt_df = pd.read_excel(egrid_file.format(year=str(year)),
-                                  sheet_name='PLNT{year}'.format(year=str(year)[-2:]),
-                                  skiprows=[0])
-    egrid_plnt_df = egrid_plnt_df[egrid_plnt_df['BACODE'] == 'NYIS'][egrid_cols]
+    nyiso_fmix_max = fmix_hist_df.max().to_dict()
+
+    # Open EPA eGRID metric data file (or its cached NYISO subset), import desired columns from the plant and balancing
+    # authority data tabs in a single pass, filter to NYISO only, set Plant Code as index and map NYISO fuel categories
+    # to the EPA fuel code.
+    plnt_sheet = 'PLNT{year}'.format(year=str(year)[-2:])
+    ba_sheet = 'BA{year}'.format(year=str(year)[-2:])
+    egrid_sheets = _read_egrid_nyis(egrid_file.format(year=str(year)),
+                                    sheets=[plnt_sheet, ba_sheet],
+                                    usecols=set(egrid_cols + ['BACODE', 'BAC2ERTA']))
+    egrid_plnt_df = egrid_sheets[plnt_sheet][egrid_cols]
+    egrid_st_df = egrid_sheets[ba_sheet]
     egrid_plnt_df = egrid_plnt_df.set_index(egrid_cols[0])
     egrid_plnt_df = egrid_plnt_df.replace({'PLFUELCT': fuel_epa_nyiso_map})
 
     # Construct a set of curves for each fuel type describing the relationship with total capacity dispatched in that
     # category and average equivalent CO2 emissions intensity.
 
-    co2_curves = dict()
-    for v in nyiso_fmix_max.keys():
-        co2_curves[v] = egrid_plnt_df[egrid_plnt_df['PLFUELCT'] == v]
-        co2_curves[v] = co2_curves[v].sort_values('CAPFAC', axis=0, ascending=False)
-        co2_curves[v]['cum_cap'] = co2_curves[v]['NAMEPCAP'].cumsum(axis=0, skipna=True)
-        co2_curves[v] = co2_curves[v].fillna(0)
-        co2_curves[v].drop(co2_curves[v][co2_curves[v]['CAPFAC'] == 0].index, inplace=True)
-        co2_hr_rate = co2_curves[v]['PLC2ERTA'] * co2_curves[v]['NAMEPCAP']
-        co2_curves[v]['cum_co2'] = co2_hr_rate.cumsum(axis=0, skipna=True)
-        co2_curves[v]['co2_rate'] = co2_curves[v]['cum_co2'] / co2_curves[v]['cum_cap']
-        co2_curves[v]['cum_cap'] = co2_curves[v]['cum_cap'] * nyiso_fmix_max[v] / co2_curves[v]['cum_cap'].max()
-        co2_curves[v] = co2_curves[v][['cum_cap', 'co2_rate']]
-
-    with open(CURVES_FILEPATH.format(year=str(year)), 'wb') as outfile:
-        pickle.dump(co2_curves, outfile)
+    # Plant is ordered by descending C.F. within each fuel, with missing C.F. last. Capacity is accumulated across the
+    # whole stack, so undispatched plant still counts towards the capacity of net consumers (negative C.F., e.g. pumped
+    # storage) sorted after it. Plant with zero or missing C.F. is then discarded before accumulating CO2.
+    plnt_df = egrid_plnt_df.sort_values(['PLFUELCT', 'CAPFAC'], ascending=[True, False], na_position='last')
+    cum_cap = plnt_df['NAMEPCAP'].groupby(plnt_df['PLFUELCT']).cumsum().fillna(0)
+    plnt_df = plnt_df.fillna({'CAPFAC': 0, 'NAMEPCAP': 0, 'PLC2ERTA': 0})
+    dispatched = plnt_df['CAPFAC'] != 0
+    plnt_df, cum_cap = plnt_df[dispatched], cum_cap[dispatched]
+    fuel = plnt_df['PLFUELCT']
+    cum_co2 = (plnt_df['PLC2ERTA'] * plnt_df['NAMEPCAP']).groupby(fuel).cumsum()
+    curves_df = pd.DataFrame({
+        'PLFUELCT': fuel,
+        'cum_cap': cum_cap * fuel.map(nyiso_fmix_max) / cum_cap.groupby(fuel).transform('max'),
+        'co2_rate': cum_co2 / cum_cap
+    })
+    co2_curves = {v: (curve['cum_cap'].to_numpy(np.float64), curve['co2_rate'].to_numpy(np.float64))
+                  for v, curve in curves_df.groupby('PLFUELCT') if v in nyiso_fmix_max}
+
+    np.savez(CURVES_FILEPATH.format(year=str(year)),
+             **{k + suffix: a for k, v in co2_curves.items() for suffix, a in zip(('__cap', '__rate'), v)})
+    _load_curves.cache_clear()  # Curves for this year may already be cached from a previous package
 
     # Check calibration against EPA published data for NYISO
-    egrid_st_df = pd.read_excel(egrid_file.format(year=str(year)),
-                                sheet_name='BA{year}'.format(year=str(year)[-2:]),
-                                skiprows=[0])
-    accuracy = co2_historical_total(year) / egrid_st_df[egrid_st_df['BACODE'] == 'NYIS']['BAC2ERTA']
+    accuracy = co2_historical_total(year, df_mix=fmix_hist_df) / egrid_st_df['BAC2ERTA']
     print('CO2 curves written for {yr}. Average CO2 intensity estimated at {acc:.1f}% of EPA reported value.'
           .format(yr=year, acc=float(accuracy)*100))
     return float(accuracy)
 
 
-def co2_historical_total(year):
-    df_mix = NYISOData(dataset='fuel_mix_5m', year=str(year)).df
-    df_mix['Natural Gas'] = df_mix['Dual Fuel'] + df_mix['Natural Gas']  # Dual fuel plant almost exclusively burns gas
-    df_mix = df_mix.drop(['Dual Fuel'], axis=1)
-    df_co2 = calc_grid_co2_avg(df_mix, year=year)
-    df_mix['total_mwh'] = df_mix.loc[:].sum(axis=1)
-    df_co2 = pd.concat([df_co2, df_mix[['total_mwh']]], axis=1)
-    total = np.sum(df_co2['total_mwh'] * df_co2['co2_rate']) / np.sum(df_co2['total_mwh'])
-    return total
+def _read_egrid_nyis(egrid_file: str, sheets: list, usecols: set):
+    """
+    Reads sheets of the EPA eGRID workbook filtered to the NYISO balancing authority. Each filtered sheet is cached as a
+    Parquet file alongside the workbook and read from there on later calls, unless the workbook has since changed. The
+    cache filename includes a checksum of the requested columns so a change of columns is not served a stale cache.
+    :param egrid_file: Filepath to the EPA eGRID data file.
+    :param sheets: Names of the sheets to read.
+    :param usecols: Names of the columns to read. Must include BACODE.
+    :return: A dict with sheet name as key and the filtered DataFrame as value.
+    """
+    cols_crc = '{:08x}'.format(zlib.crc32(','.join(sorted(usecols)).encode()))
+    cache_paths = {s: '{root}_{sheet}_NYIS_{cols}.parquet'.format(root=path.splitext(egrid_file)[0], sheet=s,
+                                                                  cols=cols_crc)
+                   for s in sheets}
+    if all(path.exists(p) and path.getmtime(p) >= path.getmtime(egrid_file) for p in cache_paths.values()):
+        return {s: pd.read_parquet(p) for s, p in cache_paths.items()}
+    egrid_sheets = pd.read_excel(egrid_file,
+                                 sheet_name=sheets,
+                                 skiprows=[0],
+                                 usecols=lambda col: col in usecols,
+                                 engine='openpyxl')
+    for s, df in egrid_sheets.items():
+        egrid_sheets[s] = df[df['BACODE'] == 'NYIS']
+        try:
+            egrid_sheets[s].to_parquet(cache_paths[s])
+        except (ImportError, OSError) as E:
+            _logger.warning('Could not cache eGRID sheet {sheet}: {err}'.format(sheet=s, err=str(E)))
+    return egrid_sheets
+
+
+def co2_historical_total(year, df_mix: pd.DataFrame = None):
+    """
+    :param year: The basis year. There must be a corresponding curve package - see README / Generating CO2 curves.
+    :param df_mix: Optional NYISO historical fuel mix data for the year with Dual Fuel already rolled up into Natural
+                   Gas. Downloaded if not provided.
+    :return: The generation-weighted average CO2 intensity for the year in kg/MWh.
+    """
+    if df_mix is None:
+        df_mix = NYISOData(dataset='fuel_mix_5m', year=str(year)).df
+        # Dual fuel plant almost exclusively burns gas
+        df_mix['Natural Gas'] = df_mix['Dual Fuel'] + df_mix['Natural Gas']
+        df_mix = df_mix.drop(['Dual Fuel'], axis=1)
+    rate, total = calc_grid_co2_avg(df_mix, year=year, return_total=True)
+    return float(np.nansum(total * rate) / np.nansum(total))
@@ -1,9 +1,15 @@
 from home_energy_nyc.co2_utils import calc_grid_co2_avg
+import numpy as np
 import pandas as pd
 import logging
 from coned import Meter
 import asyncio
-import json
+import orjson
+import os
+import time
+import tempfile
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 from influxdb import DataFrameClient
 
 
@@ -97,6 +103,9 @@ class NYISOReader(Reader):
     KEY_FMIX = 'fuel_mix'
     URL_FMIX = 'http://mis.nyiso.com/public/csv/rtfuelmix/{date}rtfuelmix.csv'
     UNIT_FMIX = 'MW'
+    TTL_FMIX = pd.Timedelta(minutes=5)  # NYISO publishes fuel mix data at 5-minute intervals
+    DTYPES_FMIX = {'Time Zone': 'category', 'Fuel Category': 'category', 'Gen MW': 'float64'}
+    CACHE_FMIX = 'nyiso_fuel_mix_{dates}.parquet'
 
     KEY_EMIS = 'emissions'
     UNIT_EMIS = 'kg_CO2eq/MWh'
@@ -104,12 +113,15 @@ class NYISOReader(Reader):
     def __init__(self,
                  measure_name_fmix: str,
                  measure_name_emis: str,
-                 database: str):
+                 database: str,
+                 cache_dir: str = None):
         """
         A class to download and hold fuel mix data from the NYISO website and calculated grid carbon intensity.
         :param measure_name_fmix: A name for the fuel mix measurement when written to InfluxDB
         :param measure_name_emis: A name for the emissions measurement when written to InfluxDB
         :param database:     Name of the InfluxDB database to which measurements should be written.
+        :param cache_dir:    Directory, private to the user, in which the last fuel mix download is cached between
+                             runs. Caching is disabled if not set.
         """
         super().__init__()
         self._measurements[self.KEY_FMIX] = Measurement(name=measure_name_fmix,
@@ -118,6 +130,7 @@ class NYISOReader(Reader):
         self._measurements[self.KEY_EMIS] = Measurement(name=measure_name_emis,
                                                         unit=self.UNIT_EMIS,
                                                         database=database)
+        self.cache_dir = cache_dir or None  # An empty config file entry also disables caching
 
     def query(self):
         """Query the NYISO website for data since midnight on the day specified."""
@@ -127,29 +140,58 @@ class NYISOReader(Reader):
     @catch_external_errors
     def fetch_data_fmix(self):
         today = pd.Timestamp('today', tz='US/Eastern')
-        yesterday = today - pd.offsets.Day(1)
-        df = pd.concat(
-            [
-                pd.read_csv(self.URL_FMIX.format(date=yesterday.strftime('%Y%m%d'))),
-                pd.read_csv(self.URL_FMIX.format(date=today.strftime('%Y%m%d')))
-            ]
-        )
+        yesterday = today - pd.DateOffset(days=1)  # Calendar day: 24 hours back can still be today after a DST change
+        dates = tuple(d.strftime('%Y%m%d') for d in (yesterday, today))
+        cache_path = None if self.cache_dir is None else os.path.join(
+            self.cache_dir, self.CACHE_FMIX.format(dates='_'.join(dates)))
+        if (cache_path is not None and os.path.exists(cache_path)
+                and time.time() - os.path.getmtime(cache_path) < self.TTL_FMIX.total_seconds()):
+            try:
+                return pd.read_parquet(cache_path)
+            except (ImportError, OSError, ValueError) as E:
+                _logger.warning('Could not read NYISO fuel mix cache {file}: {err}'.format(file=cache_path, err=str(E)))
+        urls = [self.URL_FMIX.format(date=d) for d in dates]
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:  # Download both days' files concurrently
+            df = pd.concat(list(executor.map(lambda url: pd.read_csv(url, dtype=self.DTYPES_FMIX), urls)))
         df['Gen MW'] = df['Gen MW'].astype(int)
-        df['Time Zone'] = df['Time Zone'].map(
-            {
-                'EDT': '-0400',
-                'EST': '-0500'
-            }, na_action=None)
-        df['Time Stamp'] = df['Time Stamp'] + df['Time Zone']
+        df['Time Stamp'] = df['Time Stamp'].to_numpy() + np.where(df['Time Zone'].to_numpy() == 'EDT', '-0400', '-0500')
         df = df.pivot(index='Time Stamp', columns='Fuel Category', values='Gen MW')
-        df.index = pd.to_datetime(df.index)  # Why is this an unexpected type?
+        df.columns = df.columns.astype(str)  # Fuel names are written to InfluxDB as plain field names
+        # Parse to UTC as timestamps either side of a DST change carry different offsets.
+        df.index = pd.to_datetime(df.index, format='%m/%d/%Y %H:%M:%S%z', utc=True)
+        df = df.sort_index()  # pivot sorts the timestamp strings, which is not chronological across DST or years
 
         df['Natural Gas'] = df['Dual Fuel'] + df['Natural Gas']  # Dual fuel plant almost exclusively burns gas
         df = df.drop(['Dual Fuel'], axis=1)
 
         last_timestamp = df.index.max()
         first_timestamp = last_timestamp - pd.offsets.Day(1)  # Returns the past 24 hours of data
-        return df[first_timestamp:last_timestamp]
+        df = df[first_timestamp:last_timestamp]
+        if cache_path is not None:
+            self._write_cache_fmix(df, cache_path)
+        return df
+
+    def _write_cache_fmix(self, df: pd.DataFrame, cache_path: str):
+        """Writes the fuel mix to the cache, then removes the files cached for previous days."""
+        # Written to a temporary file and moved into place so a concurrent run never reads a partial file.
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            os.close(fd)
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except (ImportError, OSError) as E:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            _logger.warning('Could not cache NYISO fuel mix to {file}: {err}'.format(file=cache_path, err=str(E)))
+            return
+        for p in glob(os.path.join(self.cache_dir, self.CACHE_FMIX.format(dates='*'))):
+            if p != cache_path:
+                try:
+                    os.remove(p)
+                except OSError as E:
+                    _logger.warning('Could not remove old NYISO fuel mix cache {file}: {err}'
+                                    .format(file=p, err=str(E)))
 
     @staticmethod
     def co2_calc(df: pd.DataFrame):
@@ -219,17 +261,19 @@ class ConEdReader(Reader):
         loop.run_until_complete(meter.browse())
         loop.close()
 
-        data = json.loads(meter.raw_data)
+        data = orjson.loads(meter.raw_data)
         if not data:
             _logger.error('Parse error in ConEdReader: No data received')
             return None
         elif 'reads' not in data:
             _logger.error('ConEdReader: Incorrect data received: {data}'.format(data=data))
         else:
-            rows = dict()
+            times = []
+            values = []
             for dct in data['reads']:
                 if dct['value'] is not None:
-                    rows[dct['endTime']] = {'electrical_energy': dct['value']}
-            df = pd.DataFrame.from_dict(rows, orient='index')
-            df.index = pd.to_datetime(df.index)  # Why does this throw a warning?
-            return df
+                    times.append(dct['endTime'])
+                    values.append(dct['value'])
+            # Parse to UTC as reads either side of a DST change carry different offsets.
+            return pd.DataFrame({'electrical_energy': values},
+                                index=pd.to_datetime(times, format='%Y-%m-%dT%H:%M:%S%z', utc=True))
@@ -2,6 +2,7 @@ from logging.handlers import RotatingFileHandler
 import logging
 from home_energy_nyc.connections import ConEdReader, NYISOReader, InfluxDBWriter
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 
 LOG_FILEPATH = r'home_energy_nyc.log'
@@ -12,13 +13,18 @@ def main():
     conf = configparser.ConfigParser()
     conf.read(CONFIG_FILEPATH)
 
-    readers = (
-        NYISOReader.from_config(conf),
-        ConEdReader.from_config(conf)
-    )
+    nyiso_reader = NYISOReader.from_config(conf)
+    coned_reader = ConEdReader.from_config(conf)
     writer = InfluxDBWriter.from_config(conf)
-    for r in readers:
-        r.query()
+
+    # Both queries are network-bound so the NYISO download runs in a worker thread while ConEd is queried. ConEd stays
+    # on the main thread as pyppeteer installs signal handlers when launching the browser.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        nyiso_query = executor.submit(nyiso_reader.query)
+        coned_reader.query()
+        nyiso_query.result()
+
+    for r in (nyiso_reader, coned_reader):
         for msr in r.measurements():
             writer.write_measurement(msr)
 
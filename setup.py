@@ -26,8 +26,11 @@ setup(
     include_package_data=True,
     install_requires=['asyncio',
                       'numpy',
+                      'openpyxl',
                       'influxdb',
+                      'orjson',
                       'pandas',
+                      'pyarrow',
                       'pyppeteer',
                       'pyotp',
                       'coned @ git+https://github.com/bvlaicu/coned.git#egg=coned',